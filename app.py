@@ -1,18 +1,38 @@
 from __future__ import annotations
 
 import csv
+import io
 import json
 import os
 import sqlite3
-from datetime import date, datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+import tempfile
+import threading
+import time
+import unicodedata
+from datetime import date, timedelta
+from operator import itemgetter
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
-from flask import Flask, jsonify, render_template, request, redirect, url_for, flash
+from flask import Flask, Response, jsonify, render_template, request, redirect, stream_with_context, url_for, flash
 
 SCHEDULE_FILE = os.environ.get("SCHEDULE_FILE", "teachers_schedule.json")
 DB_FILE = os.environ.get("DB_FILE", "substitutions.db")
 CSV_FILE = os.environ.get("CSV_FILE", "substitutions.csv")
 
+CSV_HEADERS = [
+    "date",
+    "day",
+    "period_code",
+    "period_time",
+    "absent_teacher",
+    "assigned_teacher",
+    "class_if_known",
+    "notes",
+]
+
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-key")
 
@@ -65,8 +85,24 @@ def index_for_period(period_code: str, period_index_map: Dict[str, int]) -> int:
     return period_index_map[period_code]
 
 
+def today_day_name() -> str:
+    # fixed English names match the schedule's day keys regardless of the process locale
+    return WEEKDAY_NAMES[date.today().weekday()]
+
+
+def connect_db(db_path: str = DB_FILE) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    # WAL lets readers proceed alongside a writer; NORMAL skips the per-commit fsync that WAL makes safe to drop
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
 def init_db(db_path: str = DB_FILE) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn = connect_db(db_path)
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS assignments (
@@ -84,7 +120,9 @@ def init_db(db_path: str = DB_FILE) -> sqlite3.Connection:
         )
         """
     )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_assignments_assigned_teacher ON assignments(assigned_teacher)")
+    # (assigned_teacher, date) also serves assigned_teacher-only lookups via its leftmost prefix
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_assignments_teacher_date ON assignments(assigned_teacher, date)")
+    conn.execute("DROP INDEX IF EXISTS idx_assignments_assigned_teacher")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_assignments_date ON assignments(date)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_assignments_absent_teacher ON assignments(absent_teacher)")
     conn.execute(
@@ -99,6 +137,33 @@ def init_db(db_path: str = DB_FILE) -> sqlite3.Connection:
     return conn
 
 
+def format_csv_rows(rows: List[Tuple[Any, ...]]) -> str:
+    """Format rows as CSV text, byte-for-byte what csv.writer would produce.
+
+    Assignment fields almost never need quoting, so rows are first joined with plain
+    str.join. If the separator counts show a field carrying a comma, quote or line break
+    (or a field is not a string), the batch goes through csv.writer instead.
+    """
+    if not rows:
+        return ""
+    n = len(rows)
+    try:
+        text = "\r\n".join([",".join(r) for r in rows]) + "\r\n"
+    except TypeError:
+        text = ""
+    if (
+        text
+        and text.count(",") == (len(rows[0]) - 1) * n
+        and text.count("\n") == n
+        and text.count("\r") == n
+        and '"' not in text
+    ):
+        return text
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+
 def export_csv(conn: sqlite3.Connection, path: str = CSV_FILE) -> None:
     cur = conn.execute(
         """
@@ -107,32 +172,65 @@ def export_csv(conn: sqlite3.Connection, path: str = CSV_FILE) -> None:
         ORDER BY date DESC, day, period_code
         """
     )
-    rows = cur.fetchall()
-    headers = [
-        "date",
-        "day",
-        "period_code",
-        "period_time",
-        "absent_teacher",
-        "assigned_teacher",
-        "class_if_known",
-        "notes",
-    ]
-    with open(path, "w", newline="", encoding="utf-8") as f:
+    # write a sibling temp file and swap it in, so a reader that already opened
+    # the old file keeps reading it intact
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".csv", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+            f.write(format_csv_rows([tuple(CSV_HEADERS)]))
+            # stream in chunks instead of materializing the whole table
+            while True:
+                chunk = cur.fetchmany(4096)
+                if not chunk:
+                    break
+                f.write(format_csv_rows(chunk))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def iter_csv(conn: sqlite3.Connection, flush_every: int = 1000) -> Iterator[str]:
+    """Yield the assignments table as CSV text, a batch of rows at a time."""
+    cur = conn.execute(
+        """
+        SELECT date, day, period_code, period_time, absent_teacher, assigned_teacher, class_if_known, notes
+        FROM assignments
+        ORDER BY date DESC, day, period_code
+        """
+    )
+    yield format_csv_rows([tuple(CSV_HEADERS)])
+    while True:
+        chunk = cur.fetchmany(flush_every)
+        if not chunk:
+            break
+        yield format_csv_rows(chunk)
+
+
+def append_csv_row(path: str, row: Dict[str, Any], headers: List[str] = CSV_HEADERS) -> None:
+    """Append a single assignment to the CSV, writing the header first if the file is new."""
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
-        writer.writerow(headers)
-        writer.writerows(rows)
-
-
-def was_chosen_on_date(conn: sqlite3.Connection, teacher: str, d: date) -> bool:
-    cur = conn.execute("SELECT 1 FROM assignments WHERE assigned_teacher=? AND date=? LIMIT 1", (teacher, d.isoformat()))
-    return cur.fetchone() is not None
+        if write_header:
+            writer.writerow(headers)
+        writer.writerow([row.get(h, "") for h in headers])
 
 
-def prior_assignment_count(conn: sqlite3.Connection, teacher: str) -> int:
-    cur = conn.execute("SELECT COUNT(1) FROM assignments WHERE assigned_teacher=?", (teacher,))
-    r = cur.fetchone()
-    return int(r[0] if r and r[0] is not None else 0)
+def teacher_stats(conn: sqlite3.Connection, yday_iso: str) -> Dict[str, Tuple[int, bool]]:
+    """Return {assigned_teacher: (prior_count, chosen_on_yday)} in a single query."""
+    cur = conn.execute(
+        """
+        SELECT assigned_teacher, COUNT(1), MAX(CASE WHEN date=? THEN 1 ELSE 0 END)
+        FROM assignments
+        GROUP BY assigned_teacher
+        """,
+        (yday_iso,),
+    )
+    return {t: (int(n or 0), bool(y)) for t, n, y in cur}
 
 
 def recent_assignment_count(conn: sqlite3.Connection, teacher: str, days_back_inclusive: int = 5) -> int:
@@ -146,79 +244,87 @@ def recent_assignment_count(conn: sqlite3.Connection, teacher: str, days_back_in
     return int(r[0] if r and r[0] is not None else 0)
 
 
-def resolve_class_for(schedules: Dict[str, Any], period_index_map: Dict[str, int], absent_teacher: str, day: str, period_code: str) -> Optional[str]:
+def build_schedule_grid(schedules: Dict[str, Any], periods: List[Dict[str, str]]) -> Dict[Tuple[str, str], Tuple[str, ...]]:
+    """Flatten teachers -> day -> [class, ...] into fixed-width rows keyed by (teacher, day).
+
+    Each cell is a stripped class code, "" meaning the teacher is free in that period.
+    The schedule does not change once loaded, so this is built once at startup.
+    """
+    width = len(periods)
+    grid: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+    for t, day_map in schedules.get("teachers", {}).items():
+        if not isinstance(day_map, dict):
+            continue
+        for d, arr in day_map.items():
+            arr = arr or []
+            grid[(t, d)] = tuple(
+                (arr[i].strip() if i < len(arr) and isinstance(arr[i], str) else "") for i in range(width)
+            )
+    return grid
+
+
+def build_free_by_slot(grid: Dict[Tuple[str, str], Tuple[str, ...]], teacher_names: List[str], days: List[str], period_count: int) -> Dict[Tuple[str, int], Tuple[str, ...]]:
+    """Return {(day, period_index): teachers free in that slot}, in schedule order."""
+    free_by_slot: Dict[Tuple[str, int], Tuple[str, ...]] = {}
+    for d in days:
+        rows = [(t, grid.get((t, d))) for t in teacher_names]
+        for i in range(period_count):
+            free_by_slot[(d, i)] = tuple(t for t, row in rows if row is None or not row[i])
+    return free_by_slot
+
+
+def resolve_class_for(grid: Dict[Tuple[str, str], Tuple[str, ...]], period_index_map: Dict[str, int], absent_teacher: str, day: str, period_code: str) -> Optional[str]:
     try:
         idx = index_for_period(period_code, period_index_map)
     except Exception:
         return None
-    teacher_sched = schedules.get("teachers", {}).get(absent_teacher, {})
-    arr = teacher_sched.get(day, [])
-    if idx < len(arr):
-        val = arr[idx]
-        return val if isinstance(val, str) and val.strip() else None
+    row = grid.get((absent_teacher, day), ())
+    if idx < len(row):
+        return row[idx] or None
     return None
 
 
-def periods_count_for_day(schedules: Dict[str, Any], teacher: str, day: str) -> int:
-    teacher_sched = schedules.get("teachers", {}).get(teacher, {})
-    arr = teacher_sched.get(day, [])
-    busy = sum(1 for v in arr if isinstance(v, str) and v.strip())
-    return busy
-
-
-def teacher_teaches_class(schedules: Dict[str, Any], teacher: str, class_code: str, days: Optional[List[str]] = None) -> bool:
-    if not class_code or not class_code.strip():
-        return False
-    teacher_sched = schedules.get("teachers", {}).get(teacher, {})
-    if not teacher_sched:
-        return False
-    if days is None:
-        days = list(schedules.get("metadata", {}).get("days", []))
-    for d in days:
-        arr = teacher_sched.get(d, [])
-        for v in arr:
-            if isinstance(v, str) and v.strip() == class_code:
-                return True
-    return False
-
+def periods_count_for_day(grid: Dict[Tuple[str, str], Tuple[str, ...]], teacher: str, day: str) -> int:
+    return sum(1 for v in grid.get((teacher, day), ()) if v)
 
-def classes_for_teacher(schedules: Dict[str, Any], teacher: str, days: Optional[List[str]] = None) -> List[str]:
-    """Return a de-duplicated list of class codes the teacher teaches.
 
-    If days is provided, only those days are considered. Otherwise, all schedule days are scanned.
-    """
+def classes_for_teacher(grid: Dict[Tuple[str, str], Tuple[str, ...]], teacher: str, days: List[str]) -> List[str]:
+    """Return a de-duplicated list of class codes the teacher teaches on the given days."""
+    seen = set()
     classes: List[str] = []
-    teacher_sched = schedules.get("teachers", {}).get(teacher, {})
-    if not isinstance(teacher_sched, dict) or not teacher_sched:
-        return classes
-    if days is None:
-        days = list(schedules.get("metadata", {}).get("days", []))
     for d in days:
-        arr = teacher_sched.get(d, []) or []
-        for v in arr:
-            if isinstance(v, str):
-                v = v.strip()
-                if v and v not in classes:
-                    classes.append(v)
+        for v in grid.get((teacher, d), ()):
+            if v and v not in seen:
+                seen.add(v)
+                classes.append(v)
     return classes
 
-def available_teachers(schedules: Dict[str, Any], period_index_map: Dict[str, int], day: str, period_code: str, absent_teacher: str, conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+
+def build_teachers_by_class(teacher_class_set: Dict[str, FrozenSet[str]]) -> Dict[str, FrozenSet[str]]:
+    """Invert {teacher: classes} into {class_code: teachers who take that class on any day}."""
+    by_class: Dict[str, set] = {}
+    for t, cs in teacher_class_set.items():
+        for c in cs:
+            by_class.setdefault(c, set()).add(t)
+    return {c: frozenset(ts) for c, ts in by_class.items()}
+
+def available_teachers(free_by_slot: Dict[Tuple[str, int], Tuple[str, ...]], period_index_map: Dict[str, int], day: str, period_code: str, absent_teacher: str, conn: sqlite3.Connection) -> List[Dict[str, Any]]:
     idx = index_for_period(period_code, period_index_map)
     free: List[Dict[str, Any]] = []
-    teachers = schedules.get("teachers", {})
     yday = date.today() - timedelta(days=1)
-    for t, sched in teachers.items():
-        if t == absent_teacher:
-            continue
-        arr = sched.get(day, [])
-        val = arr[idx] if idx < len(arr) else ""
-        if val == "":
-            info = {
-                "teacher": t,
-                "chosen_yesterday": was_chosen_on_date(conn, t, yday),
-                "prior_count": prior_assignment_count(conn, t),
-            }
-            free.append(info)
+    stats = teacher_stats(conn, yday.isoformat())
+    candidates = free_by_slot.get((day, idx), ())
+    # the absent teacher is normally busy in the slot being covered, so filter only when needed
+    if absent_teacher in candidates:
+        candidates = tuple(t for t in candidates if t != absent_teacher)
+    for t in candidates:
+        prior_count, chosen_yesterday = stats.get(t, (0, False))
+        info = {
+            "teacher": t,
+            "chosen_yesterday": chosen_yesterday,
+            "prior_count": prior_count,
+        }
+        free.append(info)
     # sort by chosen_yesterday (False first), prior_count, name
     free.sort(key=lambda x: (x["chosen_yesterday"], x["prior_count"], x["teacher"]))
     return free
@@ -226,11 +332,80 @@ def available_teachers(schedules: Dict[str, Any], period_index_map: Dict[str, in
 
 # ----------------------------- App Bootstrap ---------------------------------
 
-conn = init_db()
+init_db().close()
+
+# one connection per thread, so readers don't queue behind a shared handle
+_tls = threading.local()
+
+
+def get_conn() -> sqlite3.Connection:
+    c = getattr(_tls, "conn", None)
+    if c is None:
+        c = connect_db(DB_FILE)
+        _tls.conn = c
+    return c
+
+
 schedules = load_schedule(SCHEDULE_FILE)
 days = get_days(schedules)
 periods = get_periods(schedules)
 period_index_map = build_period_index_map(periods)
+period_time_by_code = {p["code"]: p["time"] for p in periods}
+schedule_grid = build_schedule_grid(schedules, periods)
+free_by_slot = build_free_by_slot(schedule_grid, list(schedules["teachers"].keys()), days, len(periods))
+busy_by_teacher_day = {key: periods_count_for_day(schedule_grid, *key) for key in schedule_grid}
+# classes taught across all days, per teacher
+teacher_all_classes = {t: classes_for_teacher(schedule_grid, t, days) for t in schedules["teachers"]}
+teacher_class_set = {t: frozenset(cs) for t, cs in teacher_all_classes.items()}
+teachers_by_class = build_teachers_by_class(teacher_class_set)
+teacher_names_sorted = tuple(sorted(schedules["teachers"].keys()))
+absent_default = teacher_names_sorted[0] if teacher_names_sorted else ""
+
+# Full CSV rewrites run on a background thread. Setting _csv_dirty requests one;
+# requests made while one is pending coalesce into a single export.
+# _csv_lock guards _csv_state and appends to CSV_FILE. It is never held while an
+# export runs; instead each export bumps "generation" when it starts and when it
+# finishes, and "exporting" counts the ones in flight. /assign appends its row only
+# if no export overlapped its write, otherwise it asks for another export. Readers
+# need no lock since exports replace the file atomically.
+_csv_dirty = threading.Event()
+_csv_lock = threading.Lock()
+_csv_state: Dict[str, Any] = {"generation": 0, "exporting": 0, "error": None}
+
+
+def run_csv_export() -> None:
+    with _csv_lock:
+        _csv_state["generation"] += 1
+        _csv_state["exporting"] += 1
+    try:
+        export_csv(get_conn(), CSV_FILE)
+        _csv_state["error"] = None
+    except Exception as e:
+        _csv_state["error"] = str(e)
+        raise
+    finally:
+        with _csv_lock:
+            _csv_state["generation"] += 1
+            _csv_state["exporting"] -= 1
+
+
+def _csv_worker() -> None:
+    backoff = 1.0
+    while True:
+        _csv_dirty.wait()
+        _csv_dirty.clear()
+        try:
+            run_csv_export()
+            backoff = 1.0
+        except Exception:
+            # rows whose append was skipped are only in the database until an export succeeds
+            app.logger.exception("CSV export failed, retrying in %.0fs", backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+            _csv_dirty.set()
+
+
+threading.Thread(target=_csv_worker, name="csv-export", daemon=True).start()
 
 
 # --------------------------------- Views -------------------------------------
@@ -238,50 +413,46 @@ period_index_map = build_period_index_map(periods)
 @app.get("/")
 def index():
     # Defaults
-    day = request.args.get("day") or datetime.today().strftime("%A")
-    absent = request.args.get("absent") or (sorted(schedules.get("teachers", {}).keys())[:1] or [""])[0]
+    day = request.args.get("day") or today_day_name()
+    absent = request.args.get("absent") or absent_default
     selected_period = request.args.get("period")
     avail = []
     # Build period dropdown to only show engaged periods for the selected absent teacher
-    engaged_periods: List[Dict[str, Any]] = []
-    try:
-        day_map = schedules.get("teachers", {}).get(absent, {}) or {}
-        arr = day_map.get(day, []) or []
-        for i, v in enumerate(arr):
-            if i < len(periods) and isinstance(v, str) and v.strip():
-                engaged_periods.append(periods[i])
-    except Exception:
-        engaged_periods = []
+    engaged_periods = [periods[i] for i, v in enumerate(schedule_grid.get((absent, day), ())) if v]
     class_code = ""
     absent_classes_today: List[str] = []
     if day and absent and selected_period:
-        class_code = resolve_class_for(schedules, period_index_map, absent, day, selected_period) or ""
+        class_code = resolve_class_for(schedule_grid, period_index_map, absent, day, selected_period) or ""
         # classes the absent teacher handles on the selected day (for quick reference)
-        absent_classes_today = classes_for_teacher(schedules, absent, [day])
-        base = available_teachers(schedules, period_index_map, day, selected_period, absent, conn)
+        absent_classes_today = classes_for_teacher(schedule_grid, absent, [day])
+        base = available_teachers(free_by_slot, period_index_map, day, selected_period, absent, get_conn())
         # filter off-day teachers (0 periods that day)
-        base = [r for r in base if periods_count_for_day(schedules, r["teacher"], day) > 0]
+        base = [r for r in base if busy_by_teacher_day.get((r["teacher"], day), 0) > 0]
         # attach fit and load
         total_periods = len(periods)
+        fits_set = teachers_by_class.get(class_code, frozenset())
         for r in base:
-            busy = periods_count_for_day(schedules, r["teacher"], day)
-            fits = teacher_teaches_class(schedules, r["teacher"], class_code, days) if class_code else False
+            busy = busy_by_teacher_day[(r["teacher"], day)]
+            fits = r["teacher"] in fits_set
             avail.append({
                 **r,
                 "fit": ("teaches " + class_code) if fits else (("not teaching " + class_code) if class_code else ""),
                 "load": f"{busy}/{total_periods}",
-                "teaches": classes_for_teacher(schedules, r["teacher"])  # across all days
+                "load_n": busy,
+                "teaches": teacher_all_classes[r["teacher"]]  # across all days
             })
-        # preferred ordering
+        # preferred ordering: class fit first, then least loaded, not chosen yesterday, fewest prior picks.
+        # available_teachers already ordered base by (chosen_yesterday, prior_count, teacher) and
+        # list.sort is stable, so sorting on the leading keys keeps those as tie-breakers
         if class_code:
-            avail = sorted(avail, key=lambda x: (x["fit"].startswith("teaches"), x["load"], x["chosen_yesterday"], x["prior_count"], x["teacher"]), reverse=True)
+            avail.sort(key=lambda x: (x["teacher"] not in fits_set, x["load_n"]))
         else:
-            avail = sorted(avail, key=lambda x: (x["load"], x["chosen_yesterday"], x["prior_count"], x["teacher"]))
+            avail.sort(key=itemgetter("load_n"))
     return render_template(
         "index.html",
         days=days,
         periods=periods,
-        teachers=sorted(schedules["teachers"].keys()),
+        teachers=teacher_names_sorted,
         avail=avail,
         selected_day=day,
         selected_absent=absent,
@@ -304,13 +475,14 @@ def assign():
         flash("Missing required fields", "error")
         return redirect(url_for("index"))
 
+    conn = get_conn()
     # optional warning
     cnt = recent_assignment_count(conn, assigned_teacher, 5)
     if cnt >= int(get_setting("warn_threshold", "2")) and get_setting("warn_repeats", "1") == "1":
         flash(f"Warning: {assigned_teacher} has been chosen {cnt} time(s) in the last 5 days.", "warning")
 
-    period_time = next((p["time"] for p in periods if p["code"] == period_code), "")
-    class_if_known = resolve_class_for(schedules, period_index_map, absent, day, period_code) or ""
+    period_time = period_time_by_code.get(period_code, "")
+    class_if_known = resolve_class_for(schedule_grid, period_index_map, absent, day, period_code) or ""
     row = {
         "date": date.today().isoformat(),
         "day": day,
@@ -321,37 +493,63 @@ def assign():
         "class_if_known": class_if_known,
         "notes": notes,
     }
+    # an export that overlaps this write may or may not see the row, so note where
+    # the exports stand before writing and compare afterwards
+    csv_generation = _csv_state["generation"]
+    # the flash message and CSV handling depend on whether the slot was already taken.
+    # BEGIN IMMEDIATE takes the write lock before the probe, so the probe, UPSERT and
+    # commit form one write transaction: a concurrent post to the same slot waits
+    # (busy_timeout) and then sees this row instead of also finding the slot empty
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        cur = conn.execute(
-            """
-            INSERT INTO assignments (date, day, period_code, period_time, absent_teacher, assigned_teacher, class_if_known, notes)
-            VALUES (:date, :day, :period_code, :period_time, :absent_teacher, :assigned_teacher, :class_if_known, :notes)
-            """,
-            row,
-        )
-        conn.commit()
-        flash("Substitute assigned", "success")
-    except sqlite3.IntegrityError:
-        # overwrite
-        conn.execute(
-            "DELETE FROM assignments WHERE date=? AND day=? AND period_code=? AND absent_teacher=?",
+        overwritten = conn.execute(
+            "SELECT 1 FROM assignments WHERE date=? AND day=? AND period_code=? AND absent_teacher=? LIMIT 1",
             (row["date"], row["day"], row["period_code"], row["absent_teacher"]),
-        )
-        conn.commit()
+        ).fetchone() is not None
         conn.execute(
             """
             INSERT INTO assignments (date, day, period_code, period_time, absent_teacher, assigned_teacher, class_if_known, notes)
             VALUES (:date, :day, :period_code, :period_time, :absent_teacher, :assigned_teacher, :class_if_known, :notes)
+            ON CONFLICT(date, day, period_code, absent_teacher) DO UPDATE SET
+                period_time=excluded.period_time,
+                assigned_teacher=excluded.assigned_teacher,
+                class_if_known=excluded.class_if_known,
+                notes=excluded.notes
             """,
             row,
         )
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if overwritten:
         flash("Existing assignment overwritten", "success")
+    else:
+        flash("Substitute assigned", "success")
 
-    try:
-        export_csv(conn, CSV_FILE)
-    except Exception as e:
-        flash(f"CSV export failed: {e}", "error")
+    with _csv_lock:
+        # `overwritten` must come from inside the write transaction above; if the slot
+        # check ran outside it, two posts to one slot could both append their row.
+        #
+        # an overwrite replaces a row already in the file, and a missing file needs
+        # the full history: leave both to the background export, as well as any row
+        # written while an export was pending, running or started since. Otherwise
+        # appending the new row is enough
+        if (
+            overwritten
+            or _csv_dirty.is_set()
+            or _csv_state["exporting"]
+            or _csv_state["generation"] != csv_generation
+            or not os.path.exists(CSV_FILE)
+        ):
+            _csv_dirty.set()
+            if _csv_state["error"]:
+                flash(f"CSV export failed: {_csv_state['error']}", "error")
+        else:
+            try:
+                append_csv_row(CSV_FILE, row)
+            except Exception as e:
+                flash(f"CSV export failed: {e}", "error")
     return redirect(url_for("index", day=day, absent=absent, period=period_code))
 
 
@@ -383,10 +581,10 @@ def history():
     sql = ("SELECT id, date, day, period_code, period_time, absent_teacher, assigned_teacher, class_if_known, notes FROM assignments")
     if where: sql += " WHERE " + " AND ".join(where)
     sql += " ORDER BY date DESC, day, period_code"
-    cur = conn.execute(sql, params)
+    cur = get_conn().execute(sql, params)
     rows = cur.fetchall()
 
-    teachers = sorted(schedules.get("teachers", {}).keys())
+    teachers = teacher_names_sorted
     period_codes = [p["code"] for p in periods]
 
     return render_template("history.html", rows=rows, q=q, teachers=teachers, days=days, periods=periods, period_codes=period_codes)
@@ -395,34 +593,51 @@ def history():
 @app.get("/routine")
 def routine():
     # Choose day: query param or today's weekday name
-    selected_day = request.args.get("day") or datetime.today().strftime("%A")
-    # Build a row per teacher with values per period
-    teacher_names = sorted(schedules.get("teachers", {}).keys())
-    period_count = len(periods)
-    rows: List[Dict[str, Any]] = []
-    for t in teacher_names:
-        day_map = schedules.get("teachers", {}).get(t, {})
-        arr = day_map.get(selected_day, []) or []
-        vals = [(arr[i] if i < len(arr) and isinstance(arr[i], str) else "") for i in range(period_count)]
-        rows.append({"teacher": t, "vals": vals})
+    selected_day = request.args.get("day") or today_day_name()
+    # Build a row per teacher with values per period; grid rows are already fixed-width
+    blank = ("",) * len(periods)
+    rows = [{"teacher": t, "vals": schedule_grid.get((t, selected_day), blank)} for t in teacher_names_sorted]
     return render_template("routine.html", days=days, periods=periods, rows=rows, selected_day=selected_day)
 
 
 @app.get("/export/csv")
 def export():
-    export_csv(conn, CSV_FILE)
-    return redirect(url_for("static_csv"))
+    # stream straight from the database rather than writing and re-reading the file
+    resp = Response(stream_with_context(iter_csv(get_conn())), mimetype="text/csv")
+    filename = os.path.basename(CSV_FILE)
+    try:
+        filename.encode("ascii")
+        resp.headers.set("Content-Disposition", "attachment", filename=filename)
+    except UnicodeEncodeError:
+        # as send_file does: an ASCII fallback plus the RFC 5987 encoded name
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        resp.headers.set("Content-Disposition", "attachment", filename=simple, **{"filename*": "UTF-8''" + quote(filename, safe="!#$&+-.^_`|~")})
+    return resp
+
+
+# settings only change through set_setting, so reads are served from memory
+_settings_cache: Dict[str, Optional[str]] = {}
 
 
 def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
-    cur = conn.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = cur.fetchone()
-    return row[0] if row else default
+    if key not in _settings_cache:
+        cur = get_conn().execute("SELECT value FROM settings WHERE key=?", (key,))
+        row = cur.fetchone()
+        _settings_cache[key] = row[0] if row else None
+    value = _settings_cache[key]
+    return value if value is not None else default
 
 
 def set_setting(key: str, value: str) -> None:
+    conn = get_conn()
     conn.execute("REPLACE INTO settings(key, value) VALUES(?, ?)", (key, value))
     conn.commit()
+    _settings_cache[key] = value
+
+
+# warm the values read on every /assign
+get_setting("warn_threshold")
+get_setting("warn_repeats")
 
 
 @app.get("/settings")
@@ -476,9 +691,10 @@ def badge(val: str) -> str:
 # Serve CSV via static route
 @app.route("/static/" + CSV_FILE)
 def static_csv():
-    if not os.path.exists(CSV_FILE):
-        export_csv(conn, CSV_FILE)
     from flask import send_file
+    if not os.path.exists(CSV_FILE):
+        run_csv_export()
+    # exports swap the file in atomically, so it can be served without the lock
     return send_file(CSV_FILE, as_attachment=True)
 
 